@@ -3,30 +3,115 @@
 # PAINEL DE GESTÃO PARA PROXY HÍBRIDO
 # Unifica WebSocket (101) e HTTP/Socks (200 OK) com autoinstalação de serviço.
 # ATUALIZADO PARA PYTHON 3
-import socket, threading, select, sys, time, os, re, json, shutil, signal
+import socket, threading, queue, selectors, collections, heapq, bisect, itertools, errno, subprocess, sys, time, os, re, json, shutil, signal
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+# orjson é opcional: se estiver instalado, substitui o json da biblioteca padrão.
+try:
+    from orjson import loads as json_loads, dumps as json_dumps
+except ImportError:
+    json_loads = json.loads
+    def json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+
+# Variáveis de ambiente numéricas: um valor inválido nunca impede o arranque (nem do painel).
+def env_int(name, default, minimum):
+    raw = os.environ.get(name)
+    if raw is None:
+        return default
+    try:
+        value = int(raw)
+    except ValueError:
+        print(f"⚠️  {name}={raw!r} não é um número inteiro; a usar {default}.", file=sys.stderr)
+        return default
+    if value < minimum:
+        print(f"⚠️  {name}={value} abaixo do mínimo; a usar {minimum}.", file=sys.stderr)
+        return minimum
+    return value
 
 # --- Configurações ---
 PASS = ''
+PASS_BYTES = PASS.encode('utf-8')
 LISTENING_ADDR = '0.0.0.0'
-BUFLEN = 8196 * 8
-TIMEOUT = 60
+# 32 KiB, potência de dois como nos relays estilo shadowsocks: fica abaixo do limiar de
+# mmap do alocador e é o tamanho do buffer de leitura de cada reactor e do splice.
+# Com poucas ligações e muito débito pode ser aumentado com PROXY_BUFLEN (mínimo 4 KiB:
+# com 0 cada recv_into devolveria 0 e todos os túneis fechariam como se fosse EOF).
+BUFLEN = env_int('PROXY_BUFLEN', 32 * 1024, 4096)
+HANDSHAKE_TIMEOUT = 60
+# Sem descritores livres (EMFILE/ENFILE) o accept pára durante este tempo em vez de girar em vazio.
+ACCEPT_RETRY = 1.0
+LISTEN_BACKLOG = 1024
+SOCKET_BUFFER = 1 << 20
+# Túneis inativos são fechados pelo keepalive do kernel quando o outro lado desaparece.
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 15
+KEEPALIVE_COUNT = 4
+# Dados por confirmar há mais tempo do que isto também derrubam o túnel (ms).
+USER_TIMEOUT = (KEEPALIVE_IDLE + KEEPALIVE_INTERVAL * KEEPALIVE_COUNT) * 1000
 DEFAULT_HOST = "127.0.0.1:22"
+# 0: silencioso, 1: erros, 2: também cada CONNECT (PROXY_LOG_LEVEL no ambiente, ou --verbose).
+LOG_LEVEL = 2 if '--verbose' in sys.argv else env_int('PROXY_LOG_LEVEL', 1, 0)
 
 # --- Configurações do Serviço ---
 INSTALL_DIR = "/opt/proxy"
 SCRIPT_NAME = "wsproxy.py"
 SERVICE_NAME = "proxy.service"
+# Processos do serviço a aceitar na mesma porta (SO_REUSEPORT); o kernel reparte as ligações.
+# Contados na máscara de afinidade (taskset/cgroups), não no total da máquina: um worker por CPU utilizável.
+WORKERS = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+# Um worker que morre antes de RESPAWN_MIN_UPTIME conta como falha no arranque: o supervisor
+# espera cada vez mais (até RESPAWN_BACKOFF_MAX) e desiste após RESPAWN_MAX_FAILURES seguidas.
+RESPAWN_MIN_UPTIME = 10
+RESPAWN_BACKOFF_MAX = 30
+RESPAWN_MAX_FAILURES = 5
 STATE_FILE = os.path.join(INSTALL_DIR, "proxy_state.json")
 
 # --- Respostas Padrão do Protocolo HTTP ---
 RESPONSE_WS = b'HTTP/1.1 101 Switching Protocols\r\n\r\n'
 RESPONSE_HTTP = b'HTTP/1.1 200 Connection established\r\n\r\n'
 RESPONSE_ERROR = b'HTTP/1.1 502 Bad Gateway\r\n\r\n'
+RESPONSE_WRONGPASS = b'HTTP/1.1 400 WrongPass!\r\n\r\n'
+
+# --- Cabeçalhos reconhecidos no pedido inicial (uma só passagem sobre o buffer) ---
+HEADER_RE = re.compile(rb'^(X-Real-Host|X-Split|X-Pass):[ \t]*([^\r\n]*)', re.IGNORECASE | re.MULTILINE)
+WS_RE = re.compile(rb'upgrade:[ \t]*websocket', re.IGNORECASE)
 
 # --- Gerenciador de Servidores Ativos (Usado apenas pelo serviço) ---
 active_servers = {}
+worker_pids = {}  # pid -> (CPU a que o worker está fixado ou None, instante do arranque)
 shutdown_requested = False
 
+# --- Registo: as threads do proxy só enfileiram, uma thread dedicada escreve ---
+def log_writer():
+    while True:
+        entries = [log_queue.get()]
+        try:
+            while True:
+                entries.append(log_queue.get_nowait())
+        except queue.Empty:
+            pass
+        # A formatação só acontece aqui, fora das threads do proxy.
+        lines = [fmt.format(*args) for fmt, args in entries]
+
+        if '--service' in sys.argv:
+            sys.stdout.write("\n".join(lines) + "\n")
+        else:
+            out = "\r" + " " * 80 + "\r" + "\n".join(lines) + "\n"
+            if main_loop_active.is_set():
+                out += "\n\033[1;96m❯ \033[1;37mEscolha uma opção: \033[0m"
+            sys.stdout.write(out)
+        sys.stdout.flush()
+
+def start_log_writer():
+    global log_queue
+    log_queue = queue.SimpleQueue()
+    threading.Thread(target=log_writer, daemon=True).start()
+
+start_log_writer()
+# Depois de um fork só a thread que o chamou existe no filho; o escritor tem de ser recriado.
+os.register_at_fork(after_in_child=start_log_writer)
+
 class Server(threading.Thread):
     def __init__(self, host, port):
         threading.Thread.__init__(self)
@@ -34,296 +119,714 @@ class Server(threading.Thread):
         self.running = False
         self.host = host
         self.port = port
-        self.threads = []
-        self.threadsLock = threading.Lock()
-        self.logLock = threading.Lock()
         self.soc = None
+        self.reactor = None
+        # Resolvido pela própria thread logo após o listen (True) ou na falha do arranque (False).
+        self.started = Future()
 
     def run(self):
         try:
             self.soc = socket.socket(socket.AF_INET)
             self.soc.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.soc.settimeout(2)
+            if hasattr(socket, 'SO_REUSEPORT'):
+                self.soc.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            # Definido antes do listen para que a escala de janela negociada já o reflita.
+            self.soc.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+            self.soc.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER)
+            # O kernel só entrega a ligação quando chegam os primeiros dados do cliente.
+            if hasattr(socket, 'TCP_DEFER_ACCEPT'):
+                self.soc.setsockopt(socket.IPPROTO_TCP, socket.TCP_DEFER_ACCEPT, HANDSHAKE_TIMEOUT)
             self.soc.bind((self.host, self.port))
-            self.soc.listen(0)
+            self.soc.listen(LISTEN_BACKLOG)
+            self.soc.setblocking(False)
+            self.reactor = ProxyReactor(self)
             self.running = True
         except Exception as e:
-            self.printLog("Erro ao iniciar o servidor na porta {}: {}".format(self.port, e))
+            self.printLog("Erro ao iniciar o servidor na porta {}: {}", self.port, e)
             self.running = False
+            self.started.set_result(False)
             return
+        self.started.set_result(True)
 
         try:
-            while self.running and not shutdown_requested:
-                try:
-                    c, addr = self.soc.accept()
-                    c.setblocking(1)
-                except socket.timeout:
-                    continue
-                except socket.error:
-                    break
-
-                conn = ConnectionHandler(c, self, addr)
-                conn.start()
-                self.addConn(conn)
+            self.reactor.run()
         finally:
             self.close_all_connections()
             if self.soc:
                 self.soc.close()
 
-    def printLog(self, log):
-        with self.logLock:
-            if '--service' in sys.argv:
-                print(log, flush=True)
-            else:
-                print("\r" + " " * 80 + "\r", end="")
-                print(log)
-                if main_loop_active.is_set():
-                    print("\n\033[1;96m❯ \033[1;37mEscolha uma opção: \033[0m", end="", flush=True)
-
-    def addConn(self, conn):
-        with self.threadsLock:
-            if self.running:
-                self.threads.append(conn)
+    def printLog(self, fmt, *args, level=1):
+        if level <= LOG_LEVEL:
+            log_queue.put((fmt, args))
 
-    def removeConn(self, conn):
-        with self.threadsLock:
-            try:
-                self.threads.remove(conn)
-            except ValueError:
-                pass
-    
     def close_all_connections(self):
-        with self.threadsLock:
-            threads = list(self.threads)
-            for c in threads:
-                c.close()
+        if self.reactor:
+            self.reactor.close_all()
 
     def close(self):
+        # O reactor acorda, sai do ciclo e fecha as conexões na própria thread.
         self.running = False
-        self.close_all_connections()
-        if self.soc:
+        if self.reactor:
+            self.reactor.wakeup()
+
+# --- Reactor (um único select/epoll por porta para todas as conexões) ---
+
+STATE_HANDSHAKE = 'handshake'
+STATE_SPLIT = 'split'
+STATE_CONNECTING = 'connecting'
+STATE_RELAY = 'relay'
+
+def tune_socket(sock):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, KEEPALIVE_INTERVAL)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, KEEPALIVE_COUNT)
+    if hasattr(socket, 'TCP_USER_TIMEOUT'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, USER_TIMEOUT)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER)
+
+# ACK imediato no accept e depois da leitura do handshake, onde a latência conta. Não é
+# permanente no Linux e fica de fora do relay: rearmar ali custaria um setsockopt por evento.
+QUICKACK = hasattr(socket, 'TCP_QUICKACK')
+
+def quickack(sock):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+
+# Cache de resolução de nomes: os destinos são quase sempre os mesmos poucos hosts.
+ADDR_CACHE_TTL = 30
+ADDR_CACHE_MAX = 256
+# getaddrinfo bloqueia: corre nestas threads para não parar os outros túneis do reactor.
+RESOLVER_THREADS = 4
+_addr_cache = {}
+
+def lookup_cached(host, port):
+    # Literais IP e entradas válidas da cache; None quando é preciso perguntar ao DNS.
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+            return family, (host, port)
+        except OSError:
+            pass
+
+    entry = _addr_cache.get((host, port))
+    if entry and entry[2] > time.monotonic():
+        return entry[0], entry[1]
+    return None
+
+def resolve(host, port):
+    cached = lookup_cached(host, port)
+    if cached:
+        return cached
+
+    soc_family, _, _, _, address = socket.getaddrinfo(host, port)[0]
+    if len(_addr_cache) >= ADDR_CACHE_MAX:
+        _addr_cache.clear()
+    _addr_cache[(host, port)] = (soc_family, address, time.monotonic() + ADDR_CACHE_TTL)
+    return soc_family, address
+
+def split_host_port(host):
+    i = host.find(':')
+    port = int(host[i+1:]) if i != -1 else 80
+    return (host[:i] if i != -1 else host), port
+
+# O destino por omissão é resolvido uma vez no arranque do serviço e fica fixo até ao reinício.
+default_target = None
+
+def resolve_default_host():
+    global default_target
+    try:
+        default_target = resolve(*split_host_port(DEFAULT_HOST))
+    except (OSError, ValueError) as e:
+        print(f"⚠️  Não foi possível resolver {DEFAULT_HOST}: {e}")
+
+class ProxyReactor:
+    def __init__(self, server):
+        self.server = server
+        self.sel = selectors.DefaultSelector()  # epoll no Linux, select nos restantes
+        self.conns = set()
+        self.deadlines = []       # [prazo, seq, conn]; conn passa a None quando a ligação deixa de precisar dele
+        self.seq = itertools.count()
+        self.accept_resume = None # instante em que o listener volta a ser registado após EMFILE
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.resolver = None      # criado na primeira resolução que falhe a cache
+        self.resolved = collections.deque()  # (conn, future) prontos, entregues via wakeup
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+        # Buffer de leitura partilhado: o reactor corre numa só thread, logo não há concorrência.
+        self.buf = bytearray(BUFLEN)
+        self.view = memoryview(self.buf)
+        self.sel.register(server.soc, selectors.EVENT_READ, self.accept)
+        self.sel.register(self.wake_r, selectors.EVENT_READ, self.drain_wakeup)
+
+    def run(self):
+        # Sem tráfego nem handshakes pendentes, o select bloqueia sem prazo.
+        heap = self.deadlines
+        while self.server.running and not shutdown_requested:
+            # Entradas canceladas no topo não devem acordar o select.
+            while heap and heap[0][2] is None:
+                heapq.heappop(heap)
+            timeout = None
+            if heap:
+                timeout = max(0, heap[0][0] - time.monotonic())
+            if self.accept_resume is not None:
+                wait = max(0, self.accept_resume - time.monotonic())
+                timeout = wait if timeout is None else min(timeout, wait)
+            for key, mask in self.sel.select(timeout):
+                key.data(key.fileobj, mask)
+            if heap:
+                self.expire_handshakes()
+            if self.accept_resume is not None and time.monotonic() >= self.accept_resume:
+                self.accept_resume = None
+                self.set_events(self.server.soc, selectors.EVENT_READ, self.accept)
+
+    def wakeup(self):
+        try:
+            self.wake_w.send(b'\0')
+        except OSError:
+            pass
+
+    def drain_wakeup(self, sock, mask):
+        try:
+            sock.recv(64)
+        except OSError:
+            pass
+        while self.resolved:
+            conn, fut = self.resolved.popleft()
+            # A ligação pode ter expirado ou fechado enquanto esperava pelo DNS.
+            if conn in self.conns:
+                conn.resolved(fut)
+
+    def resolve_async(self, conn, host, port):
+        if self.resolver is None:
+            self.resolver = ThreadPoolExecutor(RESOLVER_THREADS, thread_name_prefix='resolver')
+        fut = self.resolver.submit(resolve, host, port)
+        fut.add_done_callback(lambda f: (self.resolved.append((conn, f)), self.wakeup()))
+
+    def accept(self, soc, mask):
+        # Esvazia a fila de ligações pendentes numa única notificação.
+        while True:
             try:
-                self.soc.shutdown(socket.SHUT_RDWR)
-                self.soc.close()
-            except socket.error:
-                pass
+                c, addr = soc.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                if e.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                    # Falta transitória de recursos: pausa o listener em vez de o parar para sempre.
+                    self.server.printLog("Porta {}: {}; accept suspenso por {}s", self.server.port, e.strerror, ACCEPT_RETRY)
+                    self.set_events(soc, 0, self.accept)
+                    self.accept_resume = time.monotonic() + ACCEPT_RETRY
+                    return
+                if e.errno in (errno.ECONNABORTED, errno.EPROTO, errno.EPERM):
+                    continue
+                self.server.running = False
+                return
 
-class ConnectionHandler(threading.Thread):
-    def __init__(self, socClient, server, addr):
-        threading.Thread.__init__(self)
-        self.daemon = True
+            c.setblocking(False)
+            tune_socket(c)
+            if QUICKACK:
+                quickack(c)
+            conn = ConnectionHandler(c, self, addr)
+            self.conns.add(conn)
+            conn.deadline = [time.monotonic() + HANDSHAKE_TIMEOUT, next(self.seq), conn]
+            heapq.heappush(self.deadlines, conn.deadline)
+            self.set_events(c, selectors.EVENT_READ, conn.handle_event)
+
+    def set_events(self, sock, events, callback):
+        try:
+            key = self.sel.get_key(sock)
+        except KeyError:
+            if events:
+                self.sel.register(sock, events, callback)
+            return
+        except (ValueError, OSError):
+            # Socket já fechado (fd -1): não há nada a registar.
+            return
+        if not events:
+            self.sel.unregister(sock)
+        elif key.events != events:
+            self.sel.modify(sock, events, callback)
+
+    def unregister(self, sock):
+        try:
+            self.sel.unregister(sock)
+        except (KeyError, ValueError, OSError):
+            pass
+
+    def expire_handshakes(self):
+        # Só o handshake tem prazo; túneis já estabelecidos ficam a cargo do keepalive.
+        now = time.monotonic()
+        heap = self.deadlines
+        while heap and heap[0][0] <= now:
+            conn = heapq.heappop(heap)[2]
+            if conn is not None:
+                conn.close()
+
+    def removeConn(self, conn):
+        self.conns.discard(conn)
+
+    def close_all(self):
+        for conn in list(self.conns):
+            conn.close()
+        if self.resolver is not None:
+            self.resolver.shutdown(wait=False, cancel_futures=True)
+        self.deadlines.clear()
+        self.sel.close()
+        self.wake_r.close()
+        self.wake_w.close()
+
+class ConnectionHandler:
+    # Uma instância por ligação: sem __dict__ por objeto.
+    __slots__ = ('clientClosed', 'targetClosed', 'client', 'target', 'websocket', 'headers',
+                 'up', 'down', 'state', 'closing', 'path', 'send_200_ok', 'reactor', 'server', 'addr',
+                 'deadline')
+
+    def __init__(self, socClient, reactor, addr):
         self.clientClosed = False
         self.targetClosed = True
         self.client = socClient
-        self.client_buffer = b''
-        self.server = server
-        self.log = 'Conexão: {} na porta {}'.format(str(addr), self.server.port)
+        self.target = None
+        self.websocket = False
+        self.headers = {}
+        self.up = None    # cliente -> destino
+        self.down = None  # destino -> cliente
+        self.state = STATE_HANDSHAKE
+        self.closing = False
+        self.path = ''
+        self.send_200_ok = False
+        self.reactor = reactor
+        self.server = reactor.server
+        self.addr = addr
+        self.deadline = None  # entrada no heap de prazos do reactor enquanto o handshake decorre
+
+    def clear_deadline(self):
+        # A entrada fica no heap até expirar, mas já não mantém o handler (nem sockets e pipes) vivo.
+        if self.deadline is not None:
+            self.deadline[2] = None
+            self.deadline = None
 
     def close(self):
-        try:
-            if not self.clientClosed:
+        self.clear_deadline()
+        # O shutdown falha (ENOTCONN) depois de um RST; o close tem de acontecer na mesma.
+        self.reactor.unregister(self.client)
+        if not self.clientClosed:
+            self.clientClosed = True
+            try:
                 self.client.shutdown(socket.SHUT_RDWR)
-                self.client.close()
-        except: pass
-        finally: self.clientClosed = True
+            except OSError:
+                pass
+            self.client.close()
 
-        try:
+        if self.target is not None:
+            self.reactor.unregister(self.target)
             if not self.targetClosed:
-                self.target.shutdown(socket.SHUT_RDWR)
+                self.targetClosed = True
+                try:
+                    self.target.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
                 self.target.close()
-        except: pass
-        finally: self.targetClosed = True
 
-    def run(self):
-        try:
-            peek_buffer = self.client.recv(1024, socket.MSG_PEEK)
-            if not peek_buffer: return
+        for relay in (self.up, self.down):
+            if relay is not None:
+                relay.close_pipe()
 
-            is_websocket = b'upgrade: websocket' in peek_buffer.lower()
+        self.reactor.removeConn(self)
 
-            if is_websocket:
-                self.client.sendall(RESPONSE_WS)
-                self.client_buffer = self.client.recv(BUFLEN)
-            else:
-                self.client_buffer = self.client.recv(BUFLEN)
-            
-            if self.client_buffer:
-                self.process_request()
+    def handle_event(self, sock, mask):
+        # Eventos já recolhidos pelo select podem chegar depois de o handler ter fechado.
+        if self not in self.reactor.conns:
+            return
+        if self.state == STATE_RELAY:
+            self.doCONNECT(sock, mask)
+            return
 
+        try:
+            if self.state == STATE_HANDSHAKE:
+                self.run()
+            elif self.state == STATE_SPLIT:
+                self.client.recv_into(self.reactor.view)
+                self.check_pass()
+            elif self.state == STATE_CONNECTING:
+                self.finish_connect()
         except Exception as e:
-            self.server.printLog("Erro no handler para {}: {}".format(self.log, str(e)))
-        finally:
+            self.server.printLog("Erro no handler para Conexão: {} na porta {}: {}", self.addr, self.server.port, e)
             self.close()
-            self.server.removeConn(self)
-    
-    def process_request(self):
-        hostPort = self.findHeader(self.client_buffer, b'X-Real-Host')
-        if not hostPort:
-            hostPort = DEFAULT_HOST.encode('utf-8')
 
-        if self.findHeader(self.client_buffer, b'X-Split'):
-            self.client.recv(BUFLEN)
-        
-        passwd = self.findHeader(self.client_buffer, b'X-Pass')
-        hostPort_str = hostPort.decode('utf-8', errors='ignore')
-
-        allow = False
-        if len(PASS) == 0:
-            allow = True
-        elif passwd.decode('utf-8', errors='ignore') == PASS:
-            allow = True
-        
-        if allow:
-            self.method_CONNECT(hostPort_str, b'upgrade: websocket' not in self.client_buffer.lower())
-        else:
-            self.client.send(b'HTTP/1.1 400 WrongPass!\r\n\r\n')
+    def run(self):
+        n = self.client.recv_into(self.reactor.view)
+        if not n:
+            self.close()
+            return
+        if QUICKACK:
+            quickack(self.client)
 
-    def findHeader(self, head, header):
-        aux = head.find(header + b': ')
-        if aux == -1: return b''
-        head = head[aux+len(header)+2:]
-        aux = head.find(b'\r\n')
-        if aux == -1: return b''
-        return head[:aux]
+        # O pedido é analisado diretamente no buffer do reactor; só os valores dos cabeçalhos são copiados.
+        request = self.reactor.view[:n]
+        self.websocket = WS_RE.search(request) is not None
 
-    def connect_target(self, host):
+        if self.websocket:
+            self.client.sendall(RESPONSE_WS)
+
+        self.process_request(request)
+
+    def process_request(self, request):
+        # Vale a primeira ocorrência de cada cabeçalho, como no findHeader original
+        # (payloads de injectors encadeiam vários pedidos no mesmo buffer).
+        headers = {}
+        for m in HEADER_RE.finditer(request):
+            headers.setdefault(m.group(1).lower(), m.group(2))
+        self.headers = headers
+
+        hostPort = self.headers.get(b'x-real-host')
+        self.path = hostPort.decode('utf-8', errors='ignore') if hostPort else DEFAULT_HOST
+
+        if self.headers.get(b'x-split'):
+            # O próximo pedaço enviado pelo cliente é descartado antes de continuar.
+            self.state = STATE_SPLIT
+            return
+
+        self.check_pass()
+
+    def check_pass(self):
+        passwd = self.headers.get(b'x-pass', b'')
+
+        if not PASS_BYTES or passwd == PASS_BYTES:
+            self.method_CONNECT(self.path, not self.websocket)
+        else:
+            self.client.sendall(RESPONSE_WRONGPASS)
+            self.close()
+
+    def connect_target(self, target):
         try:
-            i = host.find(':')
-            port = int(host[i+1:]) if i != -1 else 80
-            host = host[:i] if i != -1 else host
-            
-            soc_family, _, _, _, address = socket.getaddrinfo(host, port)[0]
+            soc_family, address = target
             self.target = socket.socket(soc_family)
             self.targetClosed = False
-            self.target.connect(address)
-            return True
+            self.target.setblocking(False)
+            tune_socket(self.target)
+            err = self.target.connect_ex(address)
+            if err not in (0, errno.EINPROGRESS):
+                raise OSError(err, os.strerror(err))
         except Exception as e:
-            self.server.printLog(f"Erro ao conectar ao destino {host}:{port} - {e}")
-            return False
+            self.connect_failed(e)
+            return
+        self.reactor.set_events(self.target, selectors.EVENT_WRITE, self.handle_event)
+
+    def connect_failed(self, e):
+        self.server.printLog("Erro ao conectar ao destino {} - {}", self.path, e)
+        try:
+            self.client.sendall(RESPONSE_ERROR)
+        except OSError:
+            pass
+        self.close()
 
     def method_CONNECT(self, path, send_200_ok):
-        self.server.printLog(f"{self.log} - CONNECT {path}")
-        if self.connect_target(path):
-            if send_200_ok:
-                self.client.sendall(RESPONSE_HTTP)
-            self.doCONNECT()
+        self.server.printLog("Conexão: {} na porta {} - CONNECT {}", self.addr, self.server.port, path, level=2)
+        # O cliente só volta a ser lido quando a ligação ao destino terminar.
+        self.send_200_ok = send_200_ok
+        self.state = STATE_CONNECTING
+        self.reactor.set_events(self.client, 0, self.handle_event)
+
+        if path == DEFAULT_HOST and default_target:
+            target = default_target
         else:
+            try:
+                host, port = split_host_port(path)
+            except ValueError as e:
+                self.connect_failed(e)
+                return
+            target = lookup_cached(host, port)
+            if target is None:
+                # Sem eventos registados até a resposta do DNS chegar pelo wakeup do reactor.
+                self.reactor.resolve_async(self, host, port)
+                return
+        self.connect_target(target)
+
+    def resolved(self, fut):
+        try:
+            target = fut.result()
+        except Exception as e:
+            self.connect_failed(e)
+            return
+        self.connect_target(target)
+
+    def finish_connect(self):
+        err = self.target.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self.server.printLog("Erro ao conectar ao destino {} - {}", self.path, os.strerror(err))
             self.client.sendall(RESPONSE_ERROR)
+            self.close()
+            return
+
+        self.state = STATE_RELAY
+        self.clear_deadline()
+        self.up = Relay(self.client, self.target)
+        self.down = Relay(self.target, self.client)
+        if self.send_200_ok:
+            self.down.buf += RESPONSE_HTTP
+        self.update_events()
+
+    def update_events(self):
+        up_pending = self.up.pending()
+        down_pending = self.down.pending()
+        if self.closing and not up_pending and not down_pending:
+            self.close()
+            return
+
+        reading = not self.closing
+        cmask = (selectors.EVENT_READ if reading and not up_pending else 0) | (selectors.EVENT_WRITE if down_pending else 0)
+        tmask = (selectors.EVENT_READ if reading and not down_pending else 0) | (selectors.EVENT_WRITE if up_pending else 0)
+        self.reactor.set_events(self.client, cmask, self.handle_event)
+        self.reactor.set_events(self.target, tmask, self.handle_event)
+
+    def doCONNECT(self, sock, mask):
+        if sock is self.client:
+            outgoing, incoming = self.down, self.up
+        else:
+            outgoing, incoming = self.up, self.down
+
+        try:
+            if mask & selectors.EVENT_WRITE:
+                outgoing.flush()
+            if mask & selectors.EVENT_READ:
+                if not incoming.pump(self.reactor.view):
+                    # Fim de ligação: entrega o que ficou pendente e depois fecha o túnel.
+                    self.closing = True
+        except:
+            self.close()
+            return
+
+        self.update_events()
+
+# --- Um sentido do túnel: lê de src e escreve em dst ---
+
+SPLICE = hasattr(os, 'splice')
+SPLICE_FLAGS = (os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK) if SPLICE else 0
+# Máximo de pedaços movidos por notificação, para um túnel rápido não monopolizar o reactor.
+SPLICE_BATCH = 8
 
-    def doCONNECT(self):
-        socs = [self.client, self.target]
-        count = 0
-        error = False
-        while not error and not shutdown_requested:
-            count += 1
-            (recv, _, err) = select.select(socs, [], socs, 3)
-            if err: error = True
-            if recv:
-                for sock in recv:
-                    try:
-                        data = sock.recv(BUFLEN)
-                        if data:
-                            if sock is self.target:
-                                self.client.send(data)
-                            else:
-                                self.target.sendall(data)
-                            count = 0
-                        else:
-                            error = True
+class Relay:
+    __slots__ = ('src', 'dst', 'src_fd', 'dst_fd', 'buf', 'pipe', 'piped')
+
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+        # Descritores guardados uma vez: o ciclo de splice não chama fileno() a cada pedaço.
+        self.src_fd = src.fileno()
+        self.dst_fd = dst.fileno()
+        self.buf = bytearray()  # dados por enviar (caminho recv_into/send)
+        self.pipe = None        # (r, w) quando o splice está ativo
+        self.piped = 0          # bytes retidos no pipe por enviar
+        if SPLICE:
+            try:
+                self.pipe = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+            except OSError:
+                pass
+
+    def pending(self):
+        return bool(self.buf) or self.piped > 0
+
+    def close_pipe(self):
+        if self.pipe:
+            for fd in self.pipe:
+                os.close(fd)
+            self.pipe = None
+
+    def pump(self, view):
+        # Devolve False quando src chegou ao fim.
+        try:
+            if self.pipe and not self.buf:
+                try:
+                    # Continua enquanto src encher o pedaço e dst aceitar tudo, sem voltar ao select.
+                    src_fd, pipe_w = self.src_fd, self.pipe[1]
+                    for _ in range(SPLICE_BATCH):
+                        n = os.splice(src_fd, pipe_w, BUFLEN, flags=SPLICE_FLAGS)
+                        if not n:
+                            return False
+                        self.piped += n
+                        self.flush()
+                        if self.piped or n < BUFLEN:
                             break
-                    except:
-                        error = True
-                        break
-            if count > TIMEOUT: error = True
+                    return True
+                except OSError as e:
+                    if e.errno not in (errno.EINVAL, errno.ENOSYS) or self.piped:
+                        raise
+                    # Sem suporte para splice neste par de sockets: volta ao recv_into/send.
+                    self.close_pipe()
+
+            n = self.src.recv_into(view)
+            if not n:
+                return False
+            data = view[:n]
+            # Só escreve diretamente se não houver dados em espera, para manter a ordem.
+            if not self.pending():
+                try:
+                    data = data[self.dst.send(data):]
+                except (BlockingIOError, InterruptedError):
+                    pass
+            self.buf += data
+        except (BlockingIOError, InterruptedError):
+            pass
+        return True
+
+    def flush(self):
+        try:
+            if self.buf:
+                del self.buf[:self.dst.send(self.buf)]
+                if self.buf:
+                    return
+            if self.piped:
+                self.piped -= os.splice(self.pipe[0], self.dst_fd, self.piped, flags=SPLICE_FLAGS)
+        except (BlockingIOError, InterruptedError):
+            pass
 
 # --- Funções de Serviço e Persistência ---
 
+# Cache do estado lido do disco; só é invalidado quando o próprio painel o altera.
+_installed_cache = None
+_ports_cache = None
+
+def refresh_state():
+    global _installed_cache, _ports_cache
+    _installed_cache = None
+    _ports_cache = None
+
+def sctl(*args, check=True):
+    # systemctl executado diretamente, sem passar por /bin/sh.
+    return subprocess.run(['systemctl', *args], check=check)
+
 def is_service_installed():
-    return os.path.exists(f"/etc/systemd/system/{SERVICE_NAME}")
+    global _installed_cache
+    if _installed_cache is None:
+        _installed_cache = os.path.exists(f"/etc/systemd/system/{SERVICE_NAME}")
+    return _installed_cache
 
 def get_ports_from_state():
+    global _ports_cache
+    if _ports_cache is None:
+        try:
+            # Mantida ordenada desde a leitura: os redesenhos não voltam a ordenar.
+            with open(STATE_FILE, 'rb') as f:
+                _ports_cache = sorted(json_loads(f.read()))
+        except (OSError, ValueError, TypeError):
+            _ports_cache = []
+    return list(_ports_cache)
+
+def write_atomic(path, data):
+    # Escrito ao lado, sincronizado para disco e só então renomeado: uma falha a meio (ou uma
+    # queda de energia) nunca deixa o ficheiro truncado, nem um .tmp esquecido para trás.
+    tmp_path = path + ".tmp"
     try:
-        if os.path.exists(STATE_FILE):
-            with open(STATE_FILE, 'r') as f:
-                return json.load(f)
-    except Exception:
-        return []
-    return []
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try: os.unlink(tmp_path)
+        except OSError: pass
+        raise
 
 def save_ports_to_state(ports):
+    global _ports_cache
     os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
-    with open(STATE_FILE, 'w') as f:
-        json.dump(ports, f)
+    write_atomic(STATE_FILE, json_dumps(ports))
+    _ports_cache = list(ports)
 
 # --- Funções do Painel ---
 
+CLEAR_SCREEN = "\033[2J\033[H"
+
+# Partes fixas do menu, montadas uma única vez; só a linha de estado muda entre redesenhos.
+MENU_TOP = "\n".join([
+    "\033[1;36m" + "═" * 65,
+    "║" + " " * 63 + "║",
+    "║" + "\033[1;97m🚀 MULTIFLOW PROXY - PAINEL DE GESTÃO 🚀\033[1;36m".center(75) + "║",
+    "║" + " " * 63 + "║",
+    "╠" + "═" * 63 + "╣",
+]) + "\n"
+
+def _menu_bottom(option_1):
+    return "\n".join([
+        "║" + " " * 63 + "║",
+        "╠" + "═" * 63 + "╣",
+        "║" + " " * 63 + "║",
+        "║  \033[1;97m📋 OPÇÕES DISPONÍVEIS:\033[1;36m" + " " * 32 + "║",
+        "║" + " " * 63 + "║",
+        option_1,
+        "║    \033[1;92m[2]\033[1;37m ▶️  Abrir Porta\033[1;36m" + " " * 42 + "║",
+        "║    \033[1;91m[3]\033[1;37m ⏹️  Fechar Porta\033[1;36m" + " " * 41 + "║",
+        "║" + " " * 63 + "║",
+        "║    \033[1;90m[0]\033[1;37m 🔽 Voltar (Sair do Painel)\033[1;36m" + " " * 25 + "║",
+        "║" + " " * 63 + "║",
+        "╚" + "═" * 63 + "╝\033[0m",
+        "",
+    ]) + "\n"
+
+MENU_BOTTOM_INSTALLED = _menu_bottom("║    \033[1;91m[1]\033[1;37m ⚙️  Desinstalar Proxy\033[1;36m" + " " * 32 + "║")
+MENU_BOTTOM_NOT_INSTALLED = _menu_bottom("║    \033[1;92m[1]\033[1;37m ⚙️  Instalar Proxy (Obrigatório)\033[1;36m" + " " * 15 + "║")
+
 def display_menu():
-    clear_screen()
-    
     is_installed = is_service_installed()
     display_ports = get_ports_from_state() if is_installed else []
 
-    print("\033[1;36m" + "═" * 65)
-    print("║" + " " * 63 + "║")
-    print("║" + "\033[1;97m🚀 MULTIFLOW PROXY - PAINEL DE GESTÃO 🚀\033[1;36m".center(75) + "║")
-    print("║" + " " * 63 + "║")
-    print("╠" + "═" * 63 + "╣")
-    
     if display_ports:
-        ports_str = ", ".join(str(p) for p in sorted(display_ports))
+        ports_str = ", ".join(str(p) for p in display_ports)
         status_icon = "🟢"
         status_text = f"\033[1;32m{status_icon} ATIVO\033[1;36m"
         ports_text = f"\033[1;33mPortas: {ports_str}\033[1;36m"
-        print(f"║  \033[1;37mStatus:\033[1;36m {status_text:<20} {ports_text:<30} ║")
+        status_line = f"║  \033[1;37mStatus:\033[1;36m {status_text:<20} {ports_text:<30} ║"
     else:
         status_icon = "🔴"
         status_text = f"\033[1;31m{status_icon} INATIVO\033[1;36m"
-        print(f"║  \033[1;37mStatus:\033[1;36m {status_text:<35} ║")
-    
-    print("║" + " " * 63 + "║")
-    print("╠" + "═" * 63 + "╣")
-    print("║" + " " * 63 + "║")
-    
-    print("║  \033[1;97m📋 OPÇÕES DISPONÍVEIS:\033[1;36m" + " " * 32 + "║")
-    print("║" + " " * 63 + "║")
-    
-    if is_installed:
-        print("║    \033[1;91m[1]\033[1;37m ⚙️  Desinstalar Proxy\033[1;36m" + " " * 32 + "║")
-    else:
-        print("║    \033[1;92m[1]\033[1;37m ⚙️  Instalar Proxy (Obrigatório)\033[1;36m" + " " * 15 + "║")
+        status_line = f"║  \033[1;37mStatus:\033[1;36m {status_text:<35} ║"
+
+    # Um único write por redesenho, incluindo a limpeza do ecrã.
+    bottom = MENU_BOTTOM_INSTALLED if is_installed else MENU_BOTTOM_NOT_INSTALLED
+    sys.stdout.write(CLEAR_SCREEN + MENU_TOP + status_line + "\n" + bottom)
+    sys.stdout.flush()
 
-    print("║    \033[1;92m[2]\033[1;37m ▶️  Abrir Porta\033[1;36m" + " " * 42 + "║")
-    print("║    \033[1;91m[3]\033[1;37m ⏹️  Fechar Porta\033[1;36m" + " " * 41 + "║")
-    print("║" + " " * 63 + "║")
-    print("║    \033[1;90m[0]\033[1;37m 🔽 Voltar (Sair do Painel)\033[1;36m" + " " * 25 + "║")
-    print("║" + " " * 63 + "║")
-    print("╚" + "═" * 63 + "╝\033[0m")
-    print()
+# Cabeçalhos e avisos fixos dos ecrãs de portas, também montados uma só vez.
+OPEN_PORT_HEADER = (
+    "\033[1;96m┌─────────────────────────────────────┐\n"
+    "│       \033[1;97m🚀 ABRIR PORTA NO SERVIÇO\033[1;96m     │\n"
+    "└─────────────────────────────────────┘\033[0m\n\n"
+)
+CLOSE_PORT_HEADER = (
+    "\033[1;91m┌─────────────────────────────────────┐\n"
+    "│      \033[1;97m⏹️  FECHAR PORTA NO SERVIÇO\033[1;91m     │\n"
+    "└─────────────────────────────────────┘\033[0m\n\n"
+)
+ROOT_REQUIRED_PORTS = (
+    "\n\033[1;31m❌ Erro: Para gerir o serviço, precisa de privilégios de root.\033[0m\n"
+    f"\033[1;37m   Execute novamente com 'sudo': \033[1;33msudo python3 {os.path.basename(__file__)}\033[0m\n"
+)
 
 def start_proxy_port():
     try:
-        print("\033[1;96m┌─────────────────────────────────────┐")
-        print("│       \033[1;97m🚀 ABRIR PORTA NO SERVIÇO\033[1;96m     │")
-        print("└─────────────────────────────────────┘\033[0m")
-        print()
+        sys.stdout.write(OPEN_PORT_HEADER)
         user_input = input("\033[1;97m➤ \033[1;37mDigite a porta para abrir \033[1;90m(ou 'voltar')\033[1;37m: \033[1;33m").lower()
         if user_input.startswith('v'): return
 
         port = int(user_input)
         
         if os.geteuid() != 0:
-            print("\n\033[1;31m❌ Erro: Para gerir o serviço, precisa de privilégios de root.\033[0m")
-            print(f"\033[1;37m   Execute novamente com 'sudo': \033[1;33msudo python3 {os.path.basename(__file__)}\033[0m")
+            sys.stdout.write(ROOT_REQUIRED_PORTS)
         else:
             ports = get_ports_from_state()
             if port in ports:
                 print(f"\n\033[1;31m❌ Erro: A porta {port} já está configurada no serviço.\033[0m")
             else:
-                ports.append(port)
+                bisect.insort(ports, port)
                 save_ports_to_state(ports)
                 print(f"\n\033[1;93m⏳ Reiniciando o serviço para aplicar a nova porta {port}...\033[0m")
-                os.system(f"systemctl restart {SERVICE_NAME}")
-                print(f"\n\033[1;32m✅ Serviço reiniciado com sucesso! A porta {port} está agora ativa.\033[0m")
+                try:
+                    sctl('restart', SERVICE_NAME)
+                    print(f"\n\033[1;32m✅ Serviço reiniciado com sucesso! A porta {port} está agora ativa.\033[0m")
+                except (subprocess.CalledProcessError, OSError):
+                    print(f"\n\033[1;31m❌ Erro: Falha ao reiniciar o serviço. Verifique 'systemctl status {SERVICE_NAME}'.\033[0m")
 
     except ValueError:
         print("\n\033[1;31m❌ Erro: Entrada inválida. Digite apenas números.\033[0m")
@@ -333,18 +836,14 @@ def start_proxy_port():
 
 def stop_proxy_port():
     try:
-        print("\033[1;91m┌─────────────────────────────────────┐")
-        print("│      \033[1;97m⏹️  FECHAR PORTA NO SERVIÇO\033[1;91m     │")
-        print("└─────────────────────────────────────┘\033[0m")
-        print()
+        sys.stdout.write(CLOSE_PORT_HEADER)
         user_input = input("\033[1;97m➤ \033[1;37mDigite a porta para fechar \033[1;90m(ou 'voltar')\033[1;37m: \033[1;33m").lower()
         if user_input.startswith('v'): return
 
         port = int(user_input)
 
         if os.geteuid() != 0:
-            print("\n\033[1;31m❌ Erro: Para gerir o serviço, precisa de privilégios de root.\033[0m")
-            print(f"\033[1;37m   Execute novamente com 'sudo': \033[1;33msudo python3 {os.path.basename(__file__)}\033[0m")
+            sys.stdout.write(ROOT_REQUIRED_PORTS)
         else:
             ports = get_ports_from_state()
             if port not in ports:
@@ -353,8 +852,11 @@ def stop_proxy_port():
                 ports.remove(port)
                 save_ports_to_state(ports)
                 print(f"\n\033[1;93m⏳ Reiniciando o serviço para remover a porta {port}...\033[0m")
-                os.system(f"systemctl restart {SERVICE_NAME}")
-                print(f"\n\033[1;32m✅ Serviço reiniciado com sucesso! A porta {port} foi desativada.\033[0m")
+                try:
+                    sctl('restart', SERVICE_NAME)
+                    print(f"\n\033[1;32m✅ Serviço reiniciado com sucesso! A porta {port} foi desativada.\033[0m")
+                except (subprocess.CalledProcessError, OSError):
+                    print(f"\n\033[1;31m❌ Erro: Falha ao reiniciar o serviço. Verifique 'systemctl status {SERVICE_NAME}'.\033[0m")
 
     except ValueError:
         print("\n\033[1;31m❌ Erro: Entrada inválida. Digite apenas números.\033[0m")
@@ -363,7 +865,8 @@ def stop_proxy_port():
         input("\n\033[1;96m📱 Pressione Enter para voltar ao menu...\033[0m")
 
 def clear_screen():
-    os.system('cls' if os.name == 'nt' else 'clear')
+    sys.stdout.write(CLEAR_SCREEN)
+    sys.stdout.flush()
 
 # --- Lógica de Gestão do Serviço ---
 
@@ -392,6 +895,7 @@ def manage_service():
     input("\n\033[1;90mPressione Enter para voltar ao menu principal...\033[0m")
 
 def install_service():
+    global _installed_cache
     if os.geteuid() != 0:
         print("\n\033[1;31m❌ Erro: A instalação requer privilégios de root.\033[0m")
         print(f"\033[1;37mPor favor, execute novamente com 'sudo': \033[1;33msudo python3 {os.path.basename(__file__)}\033[0m")
@@ -413,22 +917,25 @@ WorkingDirectory={INSTALL_DIR}
 ExecStart=/usr/bin/python3 {install_path} --service
 Restart=always
 RestartSec=3
+LimitNOFILE=1048576
 [Install]
 WantedBy=multi-user.target
 """
     try:
         print(f"\033[1;93m➤ Criando diretório: {INSTALL_DIR}\033[0m")
         os.makedirs(INSTALL_DIR, exist_ok=True)
+        # Escrita atómica: o systemd nunca vê um script ou unit a meio de ser escrito.
         print(f"\033[1;93m➤ Copiando script: {install_path}\033[0m")
-        shutil.copy(script_path, install_path)
+        with open(script_path, 'rb') as f:
+            write_atomic(install_path, f.read())
+        shutil.copymode(script_path, install_path)
         print(f"\033[1;93m➤ Criando serviço: {service_path}\033[0m")
-        with open(service_path, "w") as f: f.write(service_content)
+        write_atomic(service_path, service_content.encode())
         print("\033[1;93m➤ Recarregando systemd...\033[0m")
-        os.system("systemctl daemon-reload")
-        print("\033[1;93m➤ Habilitando para boot...\033[0m")
-        os.system(f"systemctl enable {SERVICE_NAME}")
-        print("\033[1;93m➤ Iniciando serviço...\033[0m")
-        os.system(f"systemctl start {SERVICE_NAME}")
+        sctl('daemon-reload')
+        print("\033[1;93m➤ Habilitando para boot e iniciando serviço...\033[0m")
+        sctl('enable', '--now', SERVICE_NAME)
+        _installed_cache = True
         print(f"\n\033[1;32m✅ Serviço instalado e iniciado com sucesso! 🎉\033[0m")
         print(f"\033[1;37mUse 'sudo systemctl status {SERVICE_NAME}' para verificar.\033[0m")
     except Exception as e:
@@ -437,6 +944,7 @@ WantedBy=multi-user.target
         sys.exit(1)
 
 def uninstall_service(feedback=True):
+    global _installed_cache, _ports_cache
     if os.geteuid() != 0:
         print("\n\033[1;31m❌ Erro: A desinstalação requer privilégios de root. Use 'sudo'.\033[0m")
         print(f"\033[1;37mPor favor, execute novamente com 'sudo': \033[1;33msudo python3 {os.path.basename(__file__)}\033[0m")
@@ -447,18 +955,19 @@ def uninstall_service(feedback=True):
     service_path = f"/etc/systemd/system/{SERVICE_NAME}"
     
     try:
-        print("\033[1;93m➤ Parando serviço...\033[0m")
-        os.system(f"systemctl stop {SERVICE_NAME}")
-        print("\033[1;93m➤ Desabilitando serviço...\033[0m")
-        os.system(f"systemctl disable {SERVICE_NAME}")
+        # Sem check: a desinstalação também desfaz instalações incompletas.
+        print("\033[1;93m➤ Parando e desabilitando serviço...\033[0m")
+        sctl('disable', '--now', SERVICE_NAME, check=False)
         if os.path.exists(service_path):
             print(f"\033[1;93m➤ Removendo: {service_path}\033[0m")
             os.remove(service_path)
         print("\033[1;93m➤ Recarregando systemd...\033[0m")
-        os.system("systemctl daemon-reload")
+        sctl('daemon-reload', check=False)
         if os.path.isdir(INSTALL_DIR):
             print(f"\033[1;93m➤ Removendo: {INSTALL_DIR}\033[0m")
             shutil.rmtree(INSTALL_DIR)
+        _installed_cache = False
+        _ports_cache = []
         if feedback: print("\n\033[1;32m✅ Serviço desinstalado com sucesso! 🗑️\033[0m")
     except Exception as e:
         if feedback: print(f"\n\033[1;31m❌ Erro durante a desinstalação: {e}\033[0m")
@@ -475,6 +984,11 @@ def cleanup_and_exit():
     global shutdown_requested
     shutdown_requested = True
     print("\n\033[1;93m🔄 Fechando todas as conexões ativas...\033[0m")
+    for pid in worker_pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
     for port in list(active_servers.keys()):
         active_servers.pop(port).close()
     print("\033[1;32m✅ Todos os proxies foram encerrados com sucesso! 👋\033[0m")
@@ -491,7 +1005,10 @@ def main_panel():
     while not shutdown_requested:
         display_menu()
         choice = input("\033[1;96m❯ \033[1;37mEscolha uma opção: \033[1;33m").lower().strip()
-        
+
+        # O estado em disco pode ter mudado enquanto o menu esperava (outro painel, edição manual):
+        # relido uma vez por ação, nunca por redesenho.
+        refresh_state()
         is_installed = is_service_installed()
 
         if choice == '1':
@@ -516,6 +1033,53 @@ def main_panel():
     if is_service_installed():
         print("\033[1;37mO serviço permanente continua a funcionar em segundo plano.\033[0m")
 
+def start_servers(ports):
+    for port in ports:
+        if isinstance(port, int) and 0 < port < 65536:
+            server = Server(LISTENING_ADDR, port)
+            server.start()
+            try:
+                started = server.started.result(timeout=5)
+            except FutureTimeoutError:
+                # Uma porta lenta não impede as restantes; se acabar por arrancar, é fechada logo.
+                print(f"❌ A porta {port} não arrancou a tempo; ignorada.", flush=True)
+                server.started.add_done_callback(lambda f, server=server: f.result() and server.close())
+                continue
+            if started:
+                active_servers[port] = server
+    if active_servers:
+        print(f"✅ Processo {os.getpid()} ativo com as portas: {', '.join(str(p) for p in active_servers)}", flush=True)
+
+def wait_for_shutdown():
+    try:
+        while not shutdown_requested:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        signal_handler(signal.SIGINT, None)
+
+def spawn_worker(ports, cpu=None):
+    sys.stdout.flush()
+    pid = os.fork()
+    if pid == 0:
+        # Filho: corre os seus próprios reactors e nunca regressa ao código do supervisor.
+        worker_pids.clear()
+        try:
+            if cpu is not None:
+                # Um worker por CPU: o estado do reactor fica na cache desse núcleo.
+                try:
+                    os.sched_setaffinity(0, {cpu})
+                except OSError:
+                    pass
+            start_servers(ports)
+            if not active_servers:
+                # Nenhuma porta ficou ativa (em uso, sem permissão): sair com erro para que o
+                # supervisor conte a falha e aplique o recuo, em vez de ficar parado sem listeners.
+                os._exit(1)
+            wait_for_shutdown()
+        finally:
+            os._exit(0)
+    worker_pids[pid] = (cpu, time.monotonic())
+
 def main_service():
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
@@ -523,23 +1087,51 @@ def main_service():
     print("🚀 Iniciando proxy em modo de serviço...")
     
     ports = get_ports_from_state()
+    if ports:
+        resolve_default_host()
     if not ports:
         print("🟡 Nenhuma porta configurada no ficheiro de estado. O serviço está em espera.")
+    elif WORKERS > 1 and hasattr(socket, 'SO_REUSEPORT'):
+        # Supervisor: os workers são criados antes de qualquer thread de servidor existir.
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else []
+        for i in range(WORKERS):
+            spawn_worker(ports, cpus[i % len(cpus)] if cpus else None)
+        # Cada worker indica as portas que de facto abriu (start_servers).
+        print(f"🚀 A iniciar {WORKERS} processos para as portas: {', '.join(str(p) for p in ports)}", flush=True)
+        fast_failures = 0
+        while not shutdown_requested:
+            try:
+                pid, _ = os.wait()
+            except ChildProcessError:
+                break
+            if pid in worker_pids and not shutdown_requested:
+                cpu, started = worker_pids.pop(pid)
+                if time.monotonic() - started < RESPAWN_MIN_UPTIME:
+                    fast_failures += 1
+                else:
+                    fast_failures = 0
+                if fast_failures > RESPAWN_MAX_FAILURES:
+                    # Sair com erro devolve a decisão ao systemd (Restart=always, RestartSec).
+                    print(f"❌ Os processos falham logo no arranque ({fast_failures} vezes seguidas); a desistir.", flush=True)
+                    for other in worker_pids:
+                        try:
+                            os.kill(other, signal.SIGTERM)
+                        except ProcessLookupError:
+                            pass
+                    sys.exit(1)
+                delay = min(RESPAWN_BACKOFF_MAX, 2 ** (fast_failures - 1)) if fast_failures else 0
+                print(f"⚠️  Processo {pid} terminou inesperadamente; a iniciar outro em {delay}s.", flush=True)
+                time.sleep(delay)
+                if not shutdown_requested:
+                    spawn_worker(ports, cpu)
+        return
     else:
-        for port in ports:
-            if isinstance(port, int) and 0 < port < 65536:
-                server = Server(LISTENING_ADDR, port)
-                server.start()
-                if server.running:
-                    active_servers[port] = server
-        if active_servers:
-            print(f"✅ Serviço do proxy ativo com as portas: {', '.join(str(p) for p in sorted(active_servers.keys()))}")
+        start_servers(ports)
+        if not active_servers:
+            print("❌ Nenhuma porta pôde ser aberta.", flush=True)
+            sys.exit(1)
     
-    try:
-        while not shutdown_requested:
-            time.sleep(60)
-    except KeyboardInterrupt:
-        signal_handler(signal.SIGINT, None)
+    wait_for_shutdown()
 
 if __name__ == '__main__':
     if '--install-service' in sys.argv: install_service()